@@ -3,30 +3,60 @@
 Download call history from www.virginmobile.pl.
 
 Usage:
-    virgin.py [options] <number> last <count> days
-    virgin.py [options] <number> year <year>
-    virgin.py [options] <number> month <year> <month>
-    virgin.py [options] cat <file>...
+    virgin.py [options] [--csv | --jsonl] <number> last <count> days
+    virgin.py [options] [--csv | --jsonl] <number> year <year>
+    virgin.py [options] [--csv | --jsonl] <number> month <year> <month>
+    virgin.py [options] [--csv | --jsonl] cat <file>...
 
 Options:
     -c, --csv                   Produce CSV output instead of a table
+    -j, --jsonl                 Produce JSON lines output instead of a table
     -u USER, --username USER    Set username
     -p PASS, --password PASS    Set password
     -n, --no-interactive        Don't ask questions
+    --no-cache                  Don't use the on-disk response cache
 """
 from datetime import datetime, timedelta
 from getpass import getpass
-from collections import defaultdict
-import csv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import dataclasses
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import operator
+import os
 import sys
+import threading
 
 from docopt import docopt
-from tabulate import tabulate
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-@dataclasses.dataclass(frozen=True, order=True)
+MAX_WORKERS = 8
+PAGE_SIZE = 500
+WINDOW = timedelta(days=15)
+# windows are aligned to this date, so that they repeat across runs
+WINDOW_EPOCH = datetime(2000, 1, 1)
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "virginmobile",
+)
+
+
+# slotted instances are considerably smaller, but need Python 3.10+
+ENTRY_OPTIONS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclasses.dataclass(frozen=True, order=True, **ENTRY_OPTIONS)
 class Entry:
     date: datetime
     type: str
@@ -36,9 +66,104 @@ class Entry:
     number: str
 
 
+FIELDS = [f.name for f in dataclasses.fields(Entry)]
+
+# sorting on precomputed field tuples is much cheaper than the comparison
+# methods generated by the dataclass, which build the tuples on every call
+entry_key = operator.attrgetter(*FIELDS)
+
+
+# data sessions often share timestamps, datetimes are immutable so reuse them
+@functools.lru_cache(maxsize=1024)
+def parse_date(s):
+    # fixed-width "%Y-%m-%dT%H:%M:%S..." format, slicing beats strptime
+    return datetime(
+        int(s[0:4]),
+        int(s[5:7]),
+        int(s[8:10]),
+        int(s[11:13]),
+        int(s[14:16]),
+        int(s[17:19]),
+    )
+
+
+def is_cacheable(end):
+    # recent records may still show up, don't cache those
+    return end <= datetime.utcnow() - timedelta(days=2)
+
+
+def parse_record(element):
+    return Entry(
+        parse_date(element["date"]),
+        element["type"],
+        element["direction"],
+        int(element["quantity"]),
+        float(element["price"]),
+        element["number"],
+    )
+
+
+# decoded call history pages, one private file per (msisdn, start, end, page,
+# pageSize) key; only the records are stored, never the requests or cookies
+class HistoryCache(object):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+    def filename(self, key):
+        # don't leak the phone number through the file name
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.path, digest + ".json")
+
+    def get(self, key):
+        try:
+            with open(self.filename(key), "rb") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, records):
+        filename = self.filename(key)
+        # write to a private temporary file first, so that readers never see
+        # a partially written page
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(json.dumps(records).encode())
+            os.replace(tmp, filename)
+        except OSError:
+            # the cache is only an optimisation, carry on without it
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
 class VirginMobile(object):
-    def __init__(self):
+    def __init__(self, cache=True):
+        # each run creates a single instance, so there is nothing to gain
+        # from sharing the session between instances
         self.session = requests.session()
+        self.cache = None
+        if cache:
+            try:
+                self.cache = HistoryCache(CACHE_DIR)
+            except OSError:
+                # e.g. read-only or missing home directory, run uncached
+                pass
+
+        # each concurrent window has at most one request in flight, keep a
+        # connection alive for each of them
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=MAX_WORKERS,
+            max_retries=Retry(
+                total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept": "application/json"})
 
     def login(self, username, password):
         resp = self.session.post(
@@ -71,82 +196,255 @@ class VirginMobile(object):
         return self.iter_history(number, start, end)
 
     def iter_history(self, number, start, end):
-        step = timedelta(days=15)
-        end = min(end, datetime.utcnow())
-        while start <= end:
-            nend = min(end, start + step)
-            for item in self.iter_history_step(number, start, nend):
-                yield item
-            start += step
-
-    def iter_history_step(self, number, start, end):
-        FMT = "%Y-%m-%dT%H:%M:%S"
-        FMT2 = FMT + ".000+0000"
-        page = 0
-        pageSize = 500
-        while True:
-            params = {
-                "start": start.strftime(FMT),
-                "end": end.strftime(FMT),
-                "page": page,
-                "pageSize": pageSize,
-            }
-            resp = self.session.get(
-                "https://virginmobile.pl/spitfire-web-api/api/v1/selfCare/callHistory",
-                params=params,
-                headers={"msisdn": number, "Accept": "application/json"},
-            )
+        step = WINDOW
+        now = datetime.utcnow()
+        end = min(end, now)
 
-            resp.raise_for_status()
-            result = resp.json()
-            for element in result["records"]:
-                yield Entry(
-                    datetime.strptime(element["date"], FMT2),
-                    element["type"],
-                    element["direction"],
-                    int(element["quantity"]),
-                    float(element["price"]),
-                    element["number"],
+        # sparse history may fit on a single page, try the whole range first
+        if end - start > step:
+            try:
+                records = self.get_history_page(
+                    {"msisdn": number},
+                    {
+                        "start": start.isoformat(timespec="seconds"),
+                        "end": end.isoformat(timespec="seconds"),
+                        "page": 0,
+                        "pageSize": PAGE_SIZE,
+                    },
+                    is_cacheable(end),
+                    # a full page is thrown away below, don't keep it
+                    store_full=False,
                 )
+            except (requests.HTTPError, requests.exceptions.RetryError):
+                # range not accepted, fall back to windows
+                records = None
+            if records is not None and len(records) < PAGE_SIZE:
+                yield from sorted(
+                    (parse_record(element) for element in records), key=entry_key
+                )
+                return
 
-            if len(result["records"]) < pageSize:
+        # use whole windows from a fixed grid for the cacheable past, so that
+        # they keep the same request params (and cache keys) whatever the
+        # requested range
+        windows = []
+        wstart = start - (start - WINDOW_EPOCH) % step
+        while wstart <= end:
+            # end is inclusive, keep the windows disjoint
+            wend = wstart + step - timedelta(seconds=1)
+            if not is_cacheable(wend):
                 break
+            windows.append((wstart, wend))
+            wstart += step
+
+        # the rest won't be cached, don't fetch more than was asked for
+        wstart = max(wstart, start)
+        while wstart <= end:
+            wend = min(end, wstart + step - timedelta(seconds=1))
+            windows.append((wstart, wend))
+            wstart += step
 
-            page += 1
+        # set when the fetch is abandoned, windows stop after their current page
+        stop = threading.Event()
+        errors = []
 
+        def fetch(window):
+            try:
+                entries = [
+                    e
+                    for e in self.iter_history_step(number, *window, stop=stop)
+                    if start <= e.date <= end
+                ]
+            except Exception as exc:
+                errors.append(exc)
+                stop.set()
+                raise
+            if stop.is_set():
+                # cut short, the result is incomplete
+                return None
+            # sort within each window, so that the whole stream is chronological
+            entries.sort(key=entry_key)
+            return entries
+
+        # windows are independent, fetch them concurrently but yield in order;
+        # only keep MAX_WORKERS windows ahead, so that memory stays bounded
+        # even if an early window is slow
+        windows = iter(windows)
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        pending = deque()
+        try:
+            for window in itertools.islice(windows, MAX_WORKERS):
+                pending.append(executor.submit(fetch, window))
+            while pending:
+                items = pending.popleft().result()
+                if items is None:
+                    # another window failed, report its error right away
+                    raise errors[0]
+                for window in itertools.islice(windows, 1):
+                    pending.append(executor.submit(fetch, window))
+                yield from items
+        finally:
+            # on errors, Ctrl-C or early exit of the consumer don't wait for
+            # the remaining windows
+            stop.set()
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def get_history_page(self, headers, params, cacheable, store_full=True):
+        cacheable = cacheable and self.cache is not None
+        if cacheable:
+            key = [
+                headers["msisdn"],
+                params["start"],
+                params["end"],
+                params["page"],
+                params["pageSize"],
+            ]
+            records = self.cache.get(key)
+            if records is not None:
+                return records
+
+        resp = self.session.get(
+            "https://virginmobile.pl/spitfire-web-api/api/v1/selfCare/callHistory",
+            params=params,
+            headers=headers,
+        )
+
+        resp.raise_for_status()
+        if orjson is not None:
+            result = orjson.loads(resp.content)
+        else:
+            result = resp.json()
 
-def cat(a, b):
-    c = defaultdict(list)
-    for elements in [a, b]:
-        for e in elements:
-            key = (e.date, e.type)
-            c[key].append(e)
-    for key in sorted(c):
-        elements = c[key]
+        if cacheable and (store_full or len(result["records"]) < params["pageSize"]):
+            self.cache.set(key, result["records"])
+        return result["records"]
+
+    def iter_history_step(self, number, start, end, stop=None):
+        page = 0
+        pageSize = PAGE_SIZE
+        cacheable = is_cacheable(end)
+        headers = {"msisdn": number}
+        params = {
+            "start": start.isoformat(timespec="seconds"),
+            "end": end.isoformat(timespec="seconds"),
+            "page": page,
+            "pageSize": pageSize,
+        }
+
+        def get_page(page):
+            # pages are fetched one at a time, so the dict can be reused
+            params["page"] = page
+            return self.get_history_page(headers, params, cacheable)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(get_page, page)
+            while future is not None:
+                records = future.result()
+                if stop is not None and stop.is_set():
+                    return
+
+                # request the next page before processing the current one
+                if len(records) < pageSize:
+                    future = None
+                else:
+                    page += 1
+                    future = executor.submit(get_page, page)
+
+                for element in records:
+                    yield parse_record(element)
+
+
+def unique(entries):
+    # entries are sorted by date, so duplicates can only share the same date
+    date = None
+    seen = set()
+    for e in entries:
+        if e.date != date:
+            date = e.date
+            seen = set()
+        if e not in seen:
+            seen.add(e)
+            yield e
+
+
+def merge_key(e):
+    return (e.date, e.type)
+
+
+def cat(*streams):
+    # all streams are sorted already (see read_file), merge them lazily
+    merged = heapq.merge(*streams, key=merge_key)
+    for key, elements in itertools.groupby(merged, key=merge_key):
+        elements = list(elements)
         quantities = set(e.quantity for e in elements)
         assert key[1] == "DATA" or len(quantities) == 1
         yield max(elements, key=lambda e: e.quantity)
 
 
+def dump_json(entry):
+    element = dict(zip(FIELDS, entry_key(entry)))
+    if orjson is not None:
+        return orjson.dumps(element)
+    return json.dumps(
+        element, default=datetime.isoformat, separators=(",", ":")
+    ).encode()
+
+
+def read_jsonl(filename):
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(filename, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            element = loads(line)
+            yield Entry(
+                parse_date(element["date"]),
+                element["type"],
+                element["direction"],
+                element["quantity"],
+                element["cost"],
+                element["number"],
+            )
+
+
+def read_csv(filename):
+    import csv
+
+    with open(filename, "r", encoding="utf-8") as f:
+        for element in csv.DictReader(f):
+            yield Entry(
+                parse_date(element["date"]),
+                element["type"],
+                element["direction"],
+                int(element["quantity"]),
+                float(element["cost"]),
+                element["number"],
+            )
+
+
+def read_file(filename):
+    if filename.endswith(".jsonl"):
+        entries = read_jsonl(filename)
+    else:
+        entries = read_csv(filename)
+
+    # cat merges the files lazily, which only works on sorted input
+    last = None
+    for e in entries:
+        key = merge_key(e)
+        if last is not None and key < last:
+            raise SystemExit("%s is not sorted by date" % filename)
+        last = key
+        yield e
+
+
 def main():
     args = docopt(__doc__)
 
     if args["cat"]:
-        entries = []
-        for filename in args["<file>"]:
-            with open(filename, "r", encoding="utf-8") as f:
-                csv_entries = (
-                    Entry(
-                        datetime.fromisoformat(element["date"]),
-                        element["type"],
-                        element["direction"],
-                        int(element["quantity"]),
-                        float(element["cost"]),
-                        element["number"],
-                    )
-                    for element in csv.DictReader(f)
-                )
-                entries = list(cat(entries, csv_entries))
+        entries = cat(*(read_file(filename) for filename in args["<file>"]))
     else:
         number = args["<number>"]
 
@@ -164,7 +462,7 @@ def main():
             else:
                 password = getpass("password:")
 
-        vm = VirginMobile()
+        vm = VirginMobile(cache=not args["--no-cache"])
         vm.login(username, password)
 
         if args["last"]:
@@ -179,20 +477,28 @@ def main():
                 month = int(args["<month>"])
                 entries = vm.iter_history_month(number, year, month)
 
-    entries = sorted(set(entries))
-    FIELDS = [f.name for f in dataclasses.fields(Entry)]
-    if not args["--csv"]:
+    # entries arrive in chronological order, drop duplicates as they come
+    entries = unique(entries)
+    # only import the formatter that's going to be used
+    if args["--csv"]:
+        import csv
+
+        writer = csv.writer(sys.stdout)
+        writer.writerow(FIELDS)
+        writer.writerows(map(entry_key, entries))
+    elif args["--jsonl"]:
+        out = sys.stdout.buffer
+        for entry in entries:
+            out.write(dump_json(entry) + b"\n")
+    else:
+        from tabulate import tabulate
+
         print(
             tabulate(
-                [dataclasses.astuple(e) for e in entries],
+                list(map(entry_key, entries)),
                 headers=FIELDS,
             )
         )
-    else:
-        writer = csv.DictWriter(sys.stdout, FIELDS)
-        writer.writeheader()
-        for entry in entries:
-            writer.writerow(dataclasses.asdict(entry))
 
 
 if __name__ == "__main__":